@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+
+import hashlib
+import threading
+import zlib
+
+# Ratios are estimated from at most SAMPLES chunks of CHUNK_SIZE bytes each,
+# spread evenly over the data.
+CHUNK_SIZE = 16 * 1024
+SAMPLES = 16
+
+class RatioEstimator(object):
+    def __init__(self, chunk_size=CHUNK_SIZE, samples=SAMPLES, level=9):
+        self._chunk_size = chunk_size
+        self._samples = samples
+        self._level = level
+        # ratios keyed by content hash, shared by both sides and all splits.
+        self._ratios = dict()
+        # ratios keyed by part, for the entry being diffed on each thread.
+        self._shared = threading.local()
+
+    @contextmanager
+    def shared(self):
+        # Within this block, ratio() returns the first ratio estimated for
+        # each key, so both sides of an entry weigh a part by the same ratio
+        # and parts that did not change get the same estimate.
+        prev = getattr(self._shared, 'ratios', None)
+        self._shared.ratios = dict()
+        try:
+            yield
+        finally:
+            self._shared.ratios = prev
+
+    @contextmanager
+    def stored(self, stored=True):
+        # Within this block, ratio() returns 1.0 if stored is set, for entries
+        # that are stored uncompressed.
+        prev = getattr(self._shared, 'stored', False)
+        self._shared.stored = stored
+        try:
+            yield
+        finally:
+            self._shared.stored = prev
+
+    def ratio(self, data, key=None):
+        # estimated compressed size / uncompressed size of data.
+        if getattr(self._shared, 'stored', False):
+            return 1.0
+
+        shared = getattr(self._shared, 'ratios', None)
+        if key is None or shared is None:
+            return self._estimate(data)
+
+        ratio = shared.get(key)
+        if ratio is None:
+            ratio = shared[key] = self._estimate(data)
+        return ratio
+
+    def _estimate(self, data):
+        if not len(data):
+            return 1.0
+
+        key = hashlib.sha1(data).digest()
+        ratio = self._ratios.get(key)
+        if ratio is not None:
+            return ratio
+
+        view = memoryview(data)
+        chunk_size = self._chunk_size
+        chunks = (len(view) + chunk_size - 1) // chunk_size
+        step = max(1, chunks // self._samples)
+
+        raw_size = 0
+        compressed_size = 0
+        for i in range(0, min(chunks, step * self._samples), step):
+            chunk = view[i * chunk_size: (i + 1) * chunk_size]
+            # raw deflate, as used by zip entries.
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+            compressed_size += len(compressor.compress(chunk))
+            compressed_size += len(compressor.flush())
+            raw_size += len(chunk)
+
+        ratio = self._ratios[key] = float(compressed_size) / raw_size
+        return ratio
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
-from zipfile import ZipFile
+from snapshot import Snapshot, is_snapshot, path_key, write_snapshot
+from zipfile import ZIP_STORED, ZipFile
 
+import os
 import struct
+import sys
+import threading
 
 class Diff(object):
     def __init__(self, name, asize, bsize):
@@ -11,6 +19,18 @@ class Diff(object):
         self._asize = asize
         self._bsize = bsize
 
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def asize(self):
+        return self._asize
+
+    @property
+    def bsize(self):
+        return self._bsize
+
     def __str__(self):
         if self._asize > self._bsize:
             # content deleted.
@@ -18,22 +38,310 @@ class Diff(object):
         # content added.
         return '+%d %s' % (self._bsize - self._asize, self._name)
 
-def _dex_handler(name, a, b):
+# bytes of inflated entries allowed to wait for parsing.
+PREFETCH_SIZE = 64 * 1024 * 1024
+
+# number of splits analysed at the same time.
+SPLIT_WORKERS = 4
+
+DEPTH_ENTRY = 0
+DEPTH_SECTION = 1
+DEPTH_SOURCE = 2
+DEPTH_METHOD = 3
+DEPTHS = ('entry', 'section', 'source', 'method')
+
+NO_INDEX = 0xffffffff
+
+# dex versions whose header, map_list, string and type ids, class_data and
+# code_item layouts are the same.
+_DEX_MAGICS = (
+    b'dex\n035\0',
+    b'dex\n037\0',
+    b'dex\n038\0',
+    b'dex\n039\0',
+)
+
+_DEX_SECTIONS = {
+    0x0000: b'.header',
+    0x0001: b'.string_id',
+    0x0002: b'.type_id',
+    0x0003: b'.proto_id',
+    0x0004: b'.field_id',
+    0x0005: b'.method_id',
+    0x0006: b'.class_def',
+    0x0007: b'.call_site_id',
+    0x0008: b'.method_handle',
+    0x1000: b'.map',
+    0x1001: b'.typelist',
+    0x1002: b'.annotation_set_ref',
+    0x1003: b'.annotation_set',
+    0x2000: b'.class_data',
+    0x2001: b'.code',
+    0x2002: b'.string_data',
+    0x2003: b'.debug_info',
+    0x2004: b'.annotation',
+    0x2005: b'.encoded_array',
+    0x2006: b'.annotations_directory',
+    0xf000: b'.hiddenapi_class_data',
+}
+
+# dex section used to estimate the compression ratio of _dex_handler names.
+_DEX_SOURCE_SECTIONS = {
+    b'.string': b'.string_data',
+    b'.type': b'.type_id',
+    b'.proto': b'.proto_id',
+    b'.field': b'.field_id',
+    b'.method': b'.method_id',
+    b'.class': b'.class_def',
+    b'.map': b'.map',
+    b'.annotation': b'.annotation',
+    b'.typelist': b'.typelist',
+    b'.data': b'.class_data',
+    b'.link': b'.link',
+}
+
+_DEBUG_BYTECODE_ARGS = {
+    0x01: 1,
+    0x02: 1,
+    0x03: 3,
+    0x04: 4,
+    0x05: 1,
+    0x06: 1,
+    0x09: 1,
+}
+
+def _read_leb128(data, off, signed=False):
+    val = 0
+    for i in range(0, 32, 7):
+        datum = data[off]
+        off += 1
+        val |= int(datum & 0x7f) << i
+        if not (datum & 0x80):
+            if signed and datum & 0x40:
+                val |= -1 << (i + 7)
+            break
+    return (val, off)
+
+def _get_code_item_size(data, off):
+    # returns (code size, try/catch size, debug info offset)
+    code_fmt = '<6x H L L'
+    code_fmt_size = struct.calcsize(code_fmt)
+
+    code_orig_off = off
+    tries_size, debug_off, insns_size = struct.unpack(
+            code_fmt, data[off: off + code_fmt_size])
+    off += code_fmt_size + (insns_size +
+            ((insns_size & 1) if tries_size else 0)) * 2
+    code_size = off - code_orig_off
+
+    if not tries_size:
+        return (code_size, 0, debug_off)
+
+    tries_orig_off = off
+    off += tries_size * 8
+    catch_list_size, off = _read_leb128(data, off)
+
+    for j in range(catch_list_size):
+        catch_size, off = _read_leb128(data, off, True)
+        for k in range(abs(catch_size)):
+            tmp, off = _read_leb128(data, off)
+            tmp, off = _read_leb128(data, off)
+        if catch_size <= 0:
+            tmp, off = _read_leb128(data, off)
+
+    return (code_size, off - tries_orig_off, debug_off)
+
+def _get_debug_info_size(data, off):
+    debug_orig_off = off
+    tmp, off = _read_leb128(data, off)
+    param_size, off = _read_leb128(data, off)
+    for i in range(param_size):
+        tmp, off = _read_leb128(data, off)
+
+    bytecode = data[off]
+    off += 1
+
+    while bytecode:
+        bytecode_arg = _DEBUG_BYTECODE_ARGS.get(bytecode, 0)
+        while bytecode_arg:
+            if not (data[off] & 0x80):
+                bytecode_arg -= 1
+            off += 1
+        bytecode = data[off]
+        off += 1
+
+    return off - debug_orig_off
+
+def _read_enc_val(data, off):
+    arg_type = data[off]
+    off += 1
+    if arg_type == 0x1c:
+        return _read_enc_array(data, off)
+    elif arg_type == 0x1d:
+        return _read_enc_anno(data, off)
+    elif arg_type == 0x1e or arg_type == 0x1f:
+        return off
+    return off + (arg_type >> 5) + 1
+
+def _read_enc_array(data, off):
+    size, off = _read_leb128(data, off)
+    for i in range(size):
+        off = _read_enc_val(data, off)
+    return off
+
+def _read_enc_anno(data, off):
+    tmp, off = _read_leb128(data, off)
+    size, off = _read_leb128(data, off)
+    for i in range(size):
+        tmp, off = _read_leb128(data, off)
+        off = _read_enc_val(data, off)
+    return off
+
+def _decode_mutf8(s):
+    # dex strings are MUTF-8, which encodes nul as two bytes and supplementary
+    # characters as surrogate pairs; neither is valid utf-8.
+    return (s.replace(b'\xc0\x80', b'\0')
+            .decode('utf-8', 'surrogatepass')
+            .encode('utf-16-le', 'surrogatepass')
+            .decode('utf-16-le', 'replace'))
+
+def _read_u32_column(data, off, count):
+    column = array('I', data[off: off + count * 4])
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+class _DexStrings(object):
+    # String and type tables of one dex, decoded lazily from array columns so
+    # that strings shared by many classes are only scanned once per walk.
+
+    def __init__(self, data):
+        self.data = data
+
+        fmt = '<8s 48x LL LL'
+        (magic, self._strid_size, strid_off, self._typeid_size, typeid_off
+                ) = struct.unpack(fmt, data[0: struct.calcsize(fmt)])
+
+        assert magic in _DEX_MAGICS
+
+        self._str_offs = _read_u32_column(data, strid_off, self._strid_size)
+        # end of each string, or 0 if not scanned yet.
+        self._str_ends = array('I', bytes(self._strid_size * 4))
+        self._type_strids = _read_u32_column(
+                data, typeid_off, self._typeid_size)
+
+    def get_raw_str(self, strid):
+        # string data including its uleb128 length, excluding the nul.
+        assert strid < self._strid_size
+        str_off = self._str_offs[strid]
+        str_end = self._str_ends[strid]
+        if not str_end:
+            str_end = self._str_ends[strid] = self.data.index(b'\0', str_off)
+        return self.data[str_off: str_end]
+
+    def get_str(self, strid):
+        s = self.get_raw_str(strid)
+        for i, c in enumerate(s):
+            if not (c & 0x80):
+                break
+        return s[i + 1:]
+
+    def get_type(self, typeid):
+        assert typeid < self._typeid_size
+        return self.get_str(self._type_strids[typeid])
+
+def _diff_size_maps(name, a_map, b_map):
+    for map_name, b_size in b_map.items():
+        a_size = a_map.pop(map_name, 0)
+        if a_size != b_size:
+            yield Diff(name + '/' + _decode_mutf8(map_name), a_size, b_size)
+
+    for map_name, a_size in a_map.items():
+        if a_size:
+            yield Diff(name + '/' + _decode_mutf8(map_name), a_size, 0)
+
+def _get_dex_sections(f):
+    # (name, offset, size) of each dex section. Only the header and map_list
+    # are read, and each section extends to the start of the next one.
+    fmt = '<8s 24x L LL LLL'
+    (magic, file_size, header_size, endian, link_size, link_off, map_off
+            ) = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+
+    assert magic in _DEX_MAGICS
+    assert header_size == 0x70
+    assert endian == 0x12345678
+
+    sections = [(0, b'.header')]
+    if link_size:
+        sections.append((link_off, b'.link'))
+
+    if map_off:
+        f.seek(map_off)
+        (map_size,) = struct.unpack('<L', f.read(4))
+
+        fmt = '<H 2x 4x L'
+        fmt_size = struct.calcsize(fmt)
+        map_data = f.read(map_size * fmt_size)
+
+        for map_idx in range(0, map_size * fmt_size, fmt_size):
+            item_type, item_off = struct.unpack(
+                    fmt, map_data[map_idx: map_idx + fmt_size])
+            if item_type:
+                sections.append(
+                        (item_off, _DEX_SECTIONS.get(item_type, b'.data')))
+
+    sections.sort()
+    return [(section_name, section_off,
+             (sections[i + 1][0] if i + 1 < len(sections) else file_size) -
+             section_off)
+            for i, (section_off, section_name) in enumerate(sections)]
+
+def _get_dex_ratios(data, estimator):
+    # estimated compression ratio of each dex section.
+    ratios = dict()
+    for section_name, section_off, section_size in _get_dex_sections(
+            BytesIO(data)):
+        ratios[section_name] = estimator.ratio(
+                memoryview(data)[section_off: section_off + section_size],
+                section_name)
+    return ratios
+
+def _dex_section_handler(name, a, b, estimator=None):
+
+    def _get_size_map(f):
+        if estimator:
+            data = f.read()
+            f = BytesIO(data)
+
+        sizes = dict()
+        for section_name, section_off, section_size in _get_dex_sections(f):
+            if estimator:
+                section_size *= estimator.ratio(memoryview(data)[
+                        section_off: section_off + section_size], section_name)
+            sizes[section_name] = sizes.get(section_name, 0) + section_size
+        return sizes
+
+    a_map = _get_size_map(a) if a else dict()
+    b_map = _get_size_map(b) if b else dict()
+
+    for diff in _diff_size_maps(name, a_map, b_map):
+        yield diff
+
+def _dex_handler(name, a, b, estimator=None):
 
     def _get_size_map(f):
         data = f.read()
+        strings = _DexStrings(data)
         sizes = dict()
 
-        fmt = '<8s 28x LL L4x L LL LL 24x LL L'
+        fmt = '<8s 28x LL L4x L 40x LL L'
         (magic, header_size, endian, link_size, map_off,
-                strid_size, strid_off, typeid_size, typeid_off,
                 class_size, class_off, data_size
                 ) = struct.unpack(fmt, data[0: struct.calcsize(fmt)])
 
         assert magic == b'dex\n035\0'
         assert header_size == 0x70
         assert endian == 0x12345678
-        NO_INDEX = 0xffffffff
 
         all_type_list_size = 0
         all_type_list_offs = set()
@@ -42,28 +350,9 @@ def _dex_handler(name, a, b):
             if off in all_type_list_offs:
                 return 0
             all_type_list_offs.add(off)
-            (size,) = struct.unpack(
-                    '<L', data[off: off + 4])
+            (size,) = struct.unpack('<L', data[off: off + 4])
             return 4 + 2 * size
 
-        def _get_str_by_id(strid, strid_off=strid_off):
-            assert strid < strid_size
-            off = strid_off + strid * 4
-            (str_off,) = struct.unpack('<L', data[off: off + 4])
-            return data[str_off: data.index(b'\0', str_off)]
-
-        def _extract_str(s):
-            for i, c in enumerate(s):
-                if not (c & 0x80):
-                    break
-            return s[i + 1:]
-
-        def _get_type_strid(typeid):
-            assert typeid < typeid_size
-            off = typeid_off + typeid * 4
-            (strid,) = struct.unpack('<L', data[off: off + 4])
-            return strid
-
         if map_off:
             map_infos = {
                 # (name, size)
@@ -81,14 +370,15 @@ def _dex_handler(name, a, b):
             fmt = '<H 2x LL'
             fmt_size = struct.calcsize(fmt)
 
-            for map_idx in range(map_off, map_off + map_size * 4, 4):
+            for map_idx in range(map_off, map_off + map_size * fmt_size,
+                                 fmt_size):
                 item_type, item_count, item_off = struct.unpack(
                         fmt, data[map_idx: map_idx + fmt_size])
 
                 if item_type == 0x0001: # string
                     size = 0
                     for strid in range(item_count):
-                        str_size = len(_get_str_by_id(strid, item_off)) + 1
+                        str_size = len(strings.get_raw_str(strid)) + 1
                         size += 4 + str_size
                         data_size -= str_size
                     sizes[b'.string'] = sizes.get(b'.string', 0) + size
@@ -122,49 +412,40 @@ def _dex_handler(name, a, b):
         all_anno_size = 0
         all_anno_offs = set()
 
+        def _get_anno_items(off):
+            # offsets in an annotation set or annotation set ref list.
+            (size,) = struct.unpack('<L', data[off: off + 4])
+            return struct.unpack('<' + str(size) + 'L',
+                                 data[off + 4: off + size * 4 + 4])
+
+        def _get_anno_item_size(off):
+            if off in all_anno_offs:
+                return 0
+            all_anno_offs.add(off)
+            return _read_enc_anno(data, off + 1) - off
+
+        def _get_anno_set_size(off):
+            if off in all_anno_offs:
+                return 0
+            all_anno_offs.add(off)
+            items = _get_anno_items(off)
+            return 4 + len(items) * 4 + sum(
+                    _get_anno_item_size(o) for o in items)
+
+        def _get_anno_ref_size(off):
+            if off in all_anno_offs:
+                return 0
+            all_anno_offs.add(off)
+            items = _get_anno_items(off)
+            return 4 + len(items) * 4 + sum(
+                    _get_anno_set_size(o) for o in items)
+
         for class_idx in range(class_off, class_off + class_size * 0x20, 0x20):
             size = 0x20
             (type_idx, ifce_off, src_idx, anno_off,
                     cdat_off, stat_off) = struct.unpack(
                     class_fmt, data[class_idx: class_idx + class_fmt_size])
 
-            def _read_leb128(off, signed=False):
-                val = 0
-                for i in range(0, 32, 7):
-                    datum = data[off]
-                    off += 1
-                    val |= int(datum & 0x7f) << i
-                    if not (datum & 0x80):
-                        if signed and datum & 0x40:
-                            val |= -1 << (i + 7)
-                        break
-                return (val, off)
-
-            def _read_enc_val(off):
-                arg_type = data[off]
-                off += 1
-                if arg_type == 0x1c:
-                    return _read_enc_array(off)
-                elif arg_type == 0x1d:
-                    return _read_enc_anno(off)
-                elif arg_type == 0x1e or arg_type == 0x1f:
-                    return off
-                return off + (arg_type >> 5) + 1
-
-            def _read_enc_array(off):
-                size, off = _read_leb128(off)
-                for i in range(size):
-                    off = _read_enc_val(off)
-                return off
-
-            def _read_enc_anno(off):
-                tmp, off = _read_leb128(off)
-                size, off = _read_leb128(off)
-                for i in range(size):
-                    tmp, off = _read_leb128(off)
-                    off = _read_enc_val(off)
-                return off
-
             if ifce_off:
                 ifce_size = _get_type_list_size(ifce_off)
                 all_type_list_size += ifce_size
@@ -179,32 +460,6 @@ def _dex_handler(name, a, b):
                         fmt, data[anno_off: anno_off + fmt_size])
                 anno_off += fmt_size
 
-                def _get_anno_item_size(off):
-                    if off in all_anno_offs:
-                        return 0
-                    all_anno_offs.add(off)
-                    return _read_enc_anno(off + 1) - off
-
-                def _get_anno_set_size(off):
-                    if off in all_anno_offs:
-                        return 0
-                    all_anno_offs.add(off)
-                    (size,) = struct.unpack('<L', data[off: off + 4])
-                    items = struct.unpack('<' + str(size) + 'L',
-                            data[off + 4: off + size * 4 + 4])
-                    return 4 + size * 4 + sum(
-                            _get_anno_item_size(o) for o in items)
-
-                def _get_anno_ref_size(off):
-                    if off in all_anno_offs:
-                        return 0
-                    all_anno_offs.add(off)
-                    (size,) = struct.unpack('<L', data[off: off + 4])
-                    items = struct.unpack('<' + str(size) + 'L',
-                            data[off + 4: off + size * 4 + 4])
-                    return 4 + size * 4 + sum(
-                            _get_anno_set_size(o) for o in items)
-
                 fmt = '<' + '4xL' * field_size
                 fmt_size = struct.calcsize(fmt)
                 field_offs = struct.unpack(fmt, data[anno_off: anno_off + fmt_size])
@@ -234,83 +489,37 @@ def _dex_handler(name, a, b):
 
             if cdat_off:
                 cdat_orig_off = cdat_off
-                sf_size, cdat_off = _read_leb128(cdat_off)
-                if_size, cdat_off = _read_leb128(cdat_off)
-                dm_size, cdat_off = _read_leb128(cdat_off)
-                vm_size, cdat_off = _read_leb128(cdat_off)
+                sf_size, cdat_off = _read_leb128(data, cdat_off)
+                if_size, cdat_off = _read_leb128(data, cdat_off)
+                dm_size, cdat_off = _read_leb128(data, cdat_off)
+                vm_size, cdat_off = _read_leb128(data, cdat_off)
 
                 for i in range(sf_size + if_size):
-                    tmp, cdat_off = _read_leb128(cdat_off)
-                    tmp, cdat_off = _read_leb128(cdat_off)
-
-                code_fmt = '<6x H L L'
-                code_fmt_size = struct.calcsize(code_fmt)
+                    tmp, cdat_off = _read_leb128(data, cdat_off)
+                    tmp, cdat_off = _read_leb128(data, cdat_off)
 
                 for i in range(dm_size + vm_size):
-                    tmp, cdat_off = _read_leb128(cdat_off)
-                    tmp, cdat_off = _read_leb128(cdat_off)
-                    code_off, cdat_off = _read_leb128(cdat_off)
+                    tmp, cdat_off = _read_leb128(data, cdat_off)
+                    tmp, cdat_off = _read_leb128(data, cdat_off)
+                    code_off, cdat_off = _read_leb128(data, cdat_off)
 
                     if not code_off:
                         continue
 
-                    code_orig_off = code_off
-                    tries_size, debug_off, insns_size = struct.unpack(
-                            code_fmt, data[code_off: code_off + code_fmt_size])
-                    code_off += code_fmt_size + tries_size * 8 + (insns_size +
-                            ((insns_size & 1) if tries_size else 0)) * 2
-
-                    if tries_size:
-                        catch_list_size, code_off = _read_leb128(code_off)
-                    else:
-                        catch_list_size = 0
-
-                    for j in range(catch_list_size):
-                        catch_size, code_off = _read_leb128(code_off, True)
-                        for k in range(abs(catch_size)):
-                            tmp, code_off = _read_leb128(code_off)
-                            tmp, code_off = _read_leb128(code_off)
-                        if catch_size <= 0:
-                            tmp, code_off = _read_leb128(code_off)
-
-                    size += code_off - code_orig_off
-                    data_size -= code_off - code_orig_off
+                    code_size, tries_size, debug_off = _get_code_item_size(
+                            data, code_off)
+                    size += code_size + tries_size
+                    data_size -= code_size + tries_size
 
                     if not debug_off:
                         continue
 
-                    debug_orig_off = debug_off
-                    tmp, debug_off = _read_leb128(debug_off)
-                    param_size, debug_off = _read_leb128(debug_off)
-                    for i in range(param_size):
-                        tmp, debug_off = _read_leb128(debug_off)
-
-                    bytecode_args = {
-                        0x01: 1,
-                        0x02: 1,
-                        0x03: 3,
-                        0x04: 4,
-                        0x05: 1,
-                        0x06: 1,
-                        0x09: 1,
-                    }
-                    bytecode = data[debug_off]
-                    debug_off += 1
-
-                    while bytecode:
-                        bytecode_arg = bytecode_args.get(bytecode, 0)
-                        while bytecode_arg:
-                            if not (data[debug_off] & 0x80):
-                                bytecode_arg -= 1
-                            debug_off += 1
-                        bytecode = data[debug_off]
-                        debug_off += 1
-
-                    size += debug_off - debug_orig_off
-                    data_size -= debug_off - debug_orig_off
+                    debug_size = _get_debug_info_size(data, debug_off)
+                    size += debug_size
+                    data_size -= debug_size
 
                 if stat_off:
-                    stat_size = _read_enc_array(stat_off) - stat_off
+                    stat_size = _read_enc_array(data, stat_off) - stat_off
                     size += stat_size
                     data_size -= stat_size
 
@@ -323,7 +532,7 @@ def _dex_handler(name, a, b):
                 size += cdat_off - cdat_orig_off
                 data_size -= cdat_off - cdat_orig_off
 
-            src_str = (_extract_str(_get_str_by_id(src_idx))
+            src_str = (strings.get_str(src_idx)
                     if src_idx != NO_INDEX else b'.class')
             sizes[src_str] = sizes.get(src_str, 0) + size
 
@@ -337,43 +546,332 @@ def _dex_handler(name, a, b):
         sizes[b'.typelist'] = all_type_list_size
         sizes[b'.data'] = data_size
         sizes[b'.link'] = link_size
+
+        if estimator:
+            # weigh each name by the ratio of the section holding most of it;
+            # source files are mostly code.
+            ratios = _get_dex_ratios(data, estimator)
+            for map_name in sizes:
+                sizes[map_name] *= ratios.get(
+                        _DEX_SOURCE_SECTIONS.get(map_name, b'.code'), 1.0)
         return sizes
 
     a_map = _get_size_map(a) if a else dict()
     b_map = _get_size_map(b) if b else dict()
 
-    for map_name, b_size in b_map.items():
-        a_size = a_map.pop(map_name, 0)
-        if a_size != b_size:
-            yield Diff(name + '/' + map_name.decode('utf-8'), a_size, b_size)
+    for diff in _diff_size_maps(name, a_map, b_map):
+        yield diff
 
-    for map_name, a_size in a_map.items():
-        if a_size:
-            yield Diff(name + '/' + map_name.decode('utf-8'), a_size, 0)
+class _MethodTable(object):
+    # Per-method sizes of a dex, stored as columns sorted by method id.
 
-class Differ(object):
-    def __init__(self):
-        def _zip_handler(name, a, b):
-            if not a or not b:
-                with ZipFile(BytesIO((a or b).read())) as zipf:
-                    for diff in self._diff_zip(zipf if a else None,
-                                               zipf if b else None,
-                                               name + '/'):
-                        yield diff
-                return
+    def __init__(self, data=None):
+        self.methods = array('I')
+        self.classes = array('I')
+        self.code = array('I')
+        self.debug = array('I')
+        self.tries = array('I')
 
-            with ZipFile(BytesIO(a.read())) as azip:
-                with ZipFile(BytesIO(b.read())) as bzip:
-                    for diff in self._diff_zip(azip, bzip, name + '/'):
-                        yield diff
+        if not data:
+            return
+
+        self._data = data
+        self._strings = _DexStrings(data)
 
+        fmt = '<8s 28x LL 28x LL 8x LL LL'
+        (magic, header_size, endian,
+                self._protoid_size, self._protoid_off,
+                self._methodid_size, self._methodid_off,
+                class_size, class_off
+                ) = struct.unpack(fmt, data[0: struct.calcsize(fmt)])
+
+        assert magic in _DEX_MAGICS
+        assert header_size == 0x70
+        assert endian == 0x12345678
+
+        methods = self.methods
+        classes = self.classes
+        code = self.code
+        debug = self.debug
+        tries = self.tries
+
+        for class_idx in range(class_off, class_off + class_size * 0x20, 0x20):
+            (type_idx, cdat_off) = struct.unpack(
+                    '<L 20x L', data[class_idx: class_idx + 0x1c])
+            if not cdat_off:
+                continue
+
+            sf_size, cdat_off = _read_leb128(data, cdat_off)
+            if_size, cdat_off = _read_leb128(data, cdat_off)
+            dm_size, cdat_off = _read_leb128(data, cdat_off)
+            vm_size, cdat_off = _read_leb128(data, cdat_off)
+
+            for i in range(sf_size + if_size):
+                tmp, cdat_off = _read_leb128(data, cdat_off)
+                tmp, cdat_off = _read_leb128(data, cdat_off)
+
+            method_idx = 0
+            for i in range(dm_size + vm_size):
+                if i == dm_size:
+                    # method indices restart for virtual methods.
+                    method_idx = 0
+                idx_diff, cdat_off = _read_leb128(data, cdat_off)
+                tmp, cdat_off = _read_leb128(data, cdat_off)
+                code_off, cdat_off = _read_leb128(data, cdat_off)
+                method_idx += idx_diff
+
+                if not code_off:
+                    continue
+
+                code_size, tries_size, debug_off = _get_code_item_size(
+                        data, code_off)
+                methods.append(method_idx)
+                classes.append(type_idx)
+                code.append(code_size)
+                tries.append(tries_size)
+                debug.append(_get_debug_info_size(data, debug_off)
+                             if debug_off else 0)
+
+        # method ids are sorted by class, name and prototype, so sorting by
+        # method id gives the order needed for merging two tables.
+        order = sorted(range(len(methods)), key=methods.__getitem__)
+        for column in (methods, classes, code, debug, tries):
+            column[:] = array('I', (column[i] for i in order))
+
+    def __len__(self):
+        return len(self.methods)
+
+    def key(self, row):
+        # (class, name, return type, parameter types) of the method at row.
+        data = self._data
+        strings = self._strings
+        method_idx = self.methods[row]
+        assert method_idx < self._methodid_size
+        off = self._methodid_off + method_idx * 8
+        (proto_idx, name_idx) = struct.unpack('<2x H L', data[off: off + 8])
+
+        assert proto_idx < self._protoid_size
+        off = self._protoid_off + proto_idx * 12
+        (ret_idx, params_off) = struct.unpack('<4x L L', data[off: off + 12])
+
+        params = ()
+        if params_off:
+            (size,) = struct.unpack('<L', data[params_off: params_off + 4])
+            params = tuple(strings.get_type(t) for t in struct.unpack(
+                    '<' + str(size) + 'H',
+                    data[params_off + 4: params_off + 4 + size * 2]))
+
+        return (strings.get_type(self.classes[row]),
+                strings.get_str(name_idx), strings.get_type(ret_idx), params)
+
+    def sizes(self, row):
+        return (self.code[row], self.debug[row], self.tries[row])
+
+def _dex_method_handler(name, a, b, estimator=None):
+
+    def _method_name(key):
+        cls, method, ret, params = key
+        return _decode_mutf8(cls + b'->' + method + b'(' + b''.join(params) +
+                             b')' + ret)
+
+    def _get_ratios(data):
+        # ratios for (code, debug, tries) sizes.
+        if not estimator or not data:
+            return (1, 1, 1)
+        ratios = _get_dex_ratios(data, estimator)
+        return (ratios.get(b'.code', 1.0), ratios.get(b'.debug_info', 1.0),
+                ratios.get(b'.code', 1.0))
+
+    def _diff_method(key, a_sizes, b_sizes):
+        method_name = name + '/' + _method_name(key)
+        for part, a_size, b_size, a_ratio, b_ratio in zip(
+                ('/.code', '/.debug', '/.tries'),
+                a_sizes, b_sizes, a_ratios, b_ratios):
+            if a_size != b_size:
+                yield Diff(method_name + part,
+                           a_size * a_ratio, b_size * b_ratio)
+
+    a_data = a.read() if a else None
+    b_data = b.read() if b else None
+    a_table = _MethodTable(a_data)
+    b_table = _MethodTable(b_data)
+    a_ratios = _get_ratios(a_data)
+    b_ratios = _get_ratios(b_data)
+    no_sizes = (0, 0, 0)
+
+    a_row = 0
+    b_row = 0
+    a_key = a_table.key(a_row) if a_row < len(a_table) else None
+    b_key = b_table.key(b_row) if b_row < len(b_table) else None
+
+    # everything outside of methods (strings, ids, class data, annotations,
+    # static values), so that the parts add up to the whole dex.
+    a_other, b_other = (
+            (len(data) - sum(table.code) - sum(table.debug) -
+             sum(table.tries)) *
+            (estimator.ratio(data, b'.other') if estimator else 1)
+            if data else 0
+            for data, table in ((a_data, a_table), (b_data, b_table)))
+    if a_other != b_other:
+        yield Diff(name + '/.other', a_other, b_other)
+
+    while a_key is not None or b_key is not None:
+        if b_key is None or (a_key is not None and a_key < b_key):
+            # method deleted.
+            diffs = _diff_method(a_key, a_table.sizes(a_row), no_sizes)
+            a_row += 1
+        elif a_key is None or b_key < a_key:
+            # method added.
+            diffs = _diff_method(b_key, no_sizes, b_table.sizes(b_row))
+            b_row += 1
+        else:
+            # method updated.
+            diffs = _diff_method(b_key, a_table.sizes(a_row),
+                                 b_table.sizes(b_row))
+            a_row += 1
+            b_row += 1
+
+        for diff in diffs:
+            yield diff
+
+        a_key = a_table.key(a_row) if a_row < len(a_table) else None
+        b_key = b_table.key(b_row) if b_row < len(b_table) else None
+
+def get_dex_handler(depth=DEPTH_SOURCE, estimator=None):
+    if depth >= DEPTH_METHOD:
+        handler = _dex_method_handler
+    elif depth >= DEPTH_SOURCE:
+        handler = _dex_handler
+    else:
+        handler = _dex_section_handler
+
+    if estimator:
+        return partial(handler, estimator=estimator)
+    return handler
+
+def _is_split_set(f):
+    return isinstance(f, (list, tuple)) or (isinstance(f, str) and (
+            os.path.isdir(f) or f.endswith('.apks')))
+
+def _read_entry(zipf, name, lock):
+    # ZipFile.open and close update the reference count of the shared file
+    # without locking, so they are serialized; ZipFile locks the reads.
+    with lock:
+        f = zipf.open(name)
+    try:
+        return f.read()
+    finally:
+        with lock:
+            f.close()
+
+class _Memo(object):
+    # Handler results keyed by handler and content, so identical content in
+    # several splits is only parsed once.
+
+    def __init__(self):
+        self._results = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def get(self, key):
+        # returns (future, owner); the owner has to compute the result.
+        with self._lock:
+            result = self._results.get(key)
+            if result:
+                return (result, False)
+            result = self._results[key] = Future()
+            return (result, True)
+
+class _SplitSet(object):
+    # Split apks given as a list of paths, a directory or an .apks archive,
+    # named by file name so the same split matches in any of these forms.
+
+    def __init__(self, f):
+        self._zip = None
+        self._lock = threading.Lock()
+
+        if not f:
+            self._splits = dict()
+        elif isinstance(f, (list, tuple)):
+            self._splits = {os.path.basename(path): path for path in f}
+        elif os.path.isdir(f):
+            self._splits = {name: os.path.join(f, name)
+                            for name in os.listdir(f) if name.endswith('.apk')}
+        elif f.endswith('.apks'):
+            self._zip = ZipFile(f)
+            # standalone apks duplicate the splits, so only splits/ is read.
+            self._splits = {info.filename[len('splits/'):]: info.filename
+                            for info in self._zip.infolist()
+                            if info.filename.startswith('splits/') and
+                               info.filename.endswith('.apk') and
+                               '/' not in info.filename[len('splits/'):]}
+        else:
+            self._splits = {os.path.basename(f): f}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def __contains__(self, name):
+        return name in self._splits
+
+    def close(self):
+        if self._zip:
+            self._zip.close()
+
+    def names(self):
+        return self._splits.keys()
+
+    def open(self, name):
+        if name not in self._splits:
+            return None
+        if self._zip:
+            return ZipFile(BytesIO(_read_entry(self._zip, self._splits[name],
+                                               self._lock)))
+        return ZipFile(self._splits[name])
+
+class Differ(object):
+    def __init__(self, depth=DEPTH_SOURCE, estimator=None):
         self._handlers = {
-            'zip': _zip_handler,
-            'apk': _zip_handler,
-            'jar': _zip_handler,
-            'ja':  _zip_handler,
-            'dex': _dex_handler,
+            'zip': self._zip_handler,
+            'apk': self._zip_handler,
+            'jar': self._zip_handler,
+            'ja':  self._zip_handler,
+            'apks': self._zip_handler,
+            'dex': get_dex_handler(depth, estimator),
         }
+        self._depth = depth
+        # compressed sizes are reported when an estimator is given.
+        self._estimator = estimator
+
+    def _zip_handler(self, name, a, b, asize=None, bsize=None):
+        # In compressed mode, asize and bsize are the compressed sizes of the
+        # archive, and what its entries do not account for (headers and the
+        # compression of the archive itself) is reported as .overhead.
+        azip = ZipFile(BytesIO(a.read())) if a else None
+        bzip = ZipFile(BytesIO(b.read())) if b else None
+        try:
+            for diff in self._diff_zip(azip, bzip, name + '/'):
+                yield diff
+
+            if asize is None and bsize is None:
+                return
+            a_overhead, b_overhead = (
+                    size - sum(info.compress_size
+                               for info in zipf.infolist())
+                    if zipf else 0
+                    for zipf, size in ((azip, asize), (bzip, bsize)))
+            if a_overhead != b_overhead:
+                yield Diff(name + '/.overhead', a_overhead, b_overhead)
+        finally:
+            for zipf in (azip, bzip):
+                if zipf:
+                    zipf.close()
 
     def set_handler(self, ext, handler):
         self._handlers[ext] = handler
@@ -381,50 +879,326 @@ class Differ(object):
     def get_handler(self, ext):
         return self._handlers.get(ext)
 
+    def export(self, a, out):
+        write_snapshot(out, self._get_sizes(a, None))
+
     def diff_zip(self, a, b):
+        if is_snapshot(a) or is_snapshot(b):
+            for diff in self._diff_sizes(a, b):
+                yield diff
+            return
+
+        if _is_split_set(a) or _is_split_set(b):
+            for diff in self.diff_splits(a, b):
+                yield diff
+            return
+
         with ZipFile(a) as azip:
             with ZipFile(b) as bzip:
                 for diff in self._diff_zip(azip, bzip, ''):
                     yield diff
 
-    def _diff_zip(self, a, b, prefix):
-
-        def _diff_file(name, asize, bsize):
-            ext = name.rpartition('.')[-1]
-            handler = self._handlers.get(ext)
-
-            if handler:
-                for diff in handler(prefix + name,
-                                    a.open(name) if asize else None,
-                                    b.open(name) if bsize else None):
-                    yield diff
-                return
-
-            if asize != bsize:
-                yield Diff(prefix + name, asize, bsize)
+    def diff_splits(self, a, b):
+        # Diff two sets of split apks, matching splits by name. Each set can
+        # be a list of apk paths, a directory of apks or an .apks archive.
+        memo = _Memo()
+        with _SplitSet(a) as asplits:
+            with _SplitSet(b) as bsplits:
+
+                def _diff_split(name):
+                    azip = asplits.open(name)
+                    bzip = bsplits.open(name)
+                    try:
+                        return list(self._diff_zip(azip, bzip, name + '/',
+                                                   memo))
+                    finally:
+                        for zipf in (azip, bzip):
+                            if zipf:
+                                zipf.close()
+
+                names = sorted(set(asplits.names()) | set(bsplits.names()))
+                executor = ThreadPoolExecutor(max_workers=SPLIT_WORKERS)
+                try:
+                    for diffs in executor.map(_diff_split, names):
+                        for diff in diffs:
+                            yield diff
+                finally:
+                    executor.shutdown(wait=True, cancel_futures=True)
+
+    def _diff_sizes(self, a, b):
+
+        def _sorted_sizes(a, b):
+            if is_snapshot(a or b):
+                # snapshots are already sorted by path.
+                return self._get_sizes(a, b)
+            return iter(sorted(self._get_sizes(a, b),
+                               key=lambda item: path_key(item[0])))
+
+        a_sizes = _sorted_sizes(a, None)
+        b_sizes = _sorted_sizes(None, b)
+        a_name, a_size = next(a_sizes, (None, 0))
+        b_name, b_size = next(b_sizes, (None, 0))
+
+        while a_name is not None or b_name is not None:
+            a_key = path_key(a_name) if a_name is not None else None
+            b_key = path_key(b_name) if b_name is not None else None
+
+            if b_key is None or (a_key is not None and a_key < b_key):
+                # file deleted.
+                yield Diff(a_name, a_size, 0)
+                a_name, a_size = next(a_sizes, (None, 0))
+            elif a_key is None or b_key < a_key:
+                # file added.
+                yield Diff(b_name, 0, b_size)
+                b_name, b_size = next(b_sizes, (None, 0))
+            else:
+                # file updated.
+                if a_size != b_size:
+                    yield Diff(b_name, a_size, b_size)
+                a_name, a_size = next(a_sizes, (None, 0))
+                b_name, b_size = next(b_sizes, (None, 0))
+
+    def _get_sizes(self, a, b):
+        # flattened (name, size) pairs for whichever of a and b is given.
+        if _is_split_set(a or b):
+            for diff in self.diff_splits(a, b):
+                yield (diff.name, diff.asize or diff.bsize)
+            return
+
+        if is_snapshot(a or b):
+            with Snapshot(a or b) as snapshot:
+                for item in snapshot.items():
+                    yield item
+            return
+
+        with ZipFile(a or b) as zipf:
+            for diff in self._diff_zip(zipf if a else None,
+                                       zipf if b else None, ''):
+                yield (diff.name, diff.asize or diff.bsize)
+
+    def _diff_compressed(self, handler, name, a, b, afile, bfile):
+        # Attribute the compressed size of each side to the parts reported by
+        # the handler, using their estimated compressed sizes. Both sides share
+        # the ratio of each part, so unchanged parts get the same estimate, and
+        # whatever the estimates do not account for is reported as .overhead.
+        # Parts of stored entries take their uncompressed size.
+
+        def _get_parts(f, info, a_side):
+            if not f:
+                return dict()
+            with self._estimator.stored(info.compress_type == ZIP_STORED):
+                return {diff.name:
+                            int(round(diff.asize if a_side else diff.bsize))
+                        for diff in handler(name, f if a_side else None,
+                                            None if a_side else f)}
+
+        with self._estimator.shared():
+            a_parts = _get_parts(a, afile, True)
+            b_parts = _get_parts(b, bfile, False)
+
+        for parts, info in ((a_parts, afile), (b_parts, bfile)):
+            parts[name + '/.overhead'] = (
+                    (info.compress_size if info else 0) - sum(parts.values()))
+
+        for part_name, b_size in b_parts.items():
+            a_size = a_parts.pop(part_name, 0)
+            if a_size != b_size:
+                yield Diff(part_name, a_size, b_size)
+
+        for part_name, a_size in a_parts.items():
+            if a_size:
+                yield Diff(part_name, a_size, 0)
+
+    def _run_handler(self, handler, name, a, b, afile, bfile):
+        if not self._estimator:
+            return handler(name, a, b)
+        if handler == self._zip_handler:
+            # nested archives are diffed with both sides together, so their
+            # identical entries are skipped, and each entry reports its own
+            # compressed size.
+            return handler(name, a, b,
+                           afile.compress_size if afile else 0,
+                           bfile.compress_size if bfile else 0)
+        return self._diff_compressed(handler, name, a, b, afile, bfile)
+
+    def _run_memoized(self, memo, key, handler, name, a, b, afile, bfile):
+        result, owner = memo.get(key)
+
+        if owner:
+            try:
+                result.set_result([(diff.name[len(name):],
+                                    diff.asize, diff.bsize)
+                                   for diff in self._run_handler(
+                                           handler, name, a, b,
+                                           afile, bfile)])
+            except BaseException as e:
+                result.set_exception(e)
+                raise
+
+        for suffix, asize, bsize in result.result():
+            yield Diff(name + suffix, asize, bsize)
+
+    def _diff_zip(self, a, b, prefix, memo=None):
+        # Handler results are only memoized when a memo is given. Nested zips
+        # are diffed without one, so their results are only stored as part
+        # of the outermost entry.
+
+        # a and b can be the same ZipFile, so both share one lock.
+        lock = threading.Lock()
+
+        def _get_handler(name):
+            if self._depth <= DEPTH_ENTRY:
+                return None
+            return self._handlers.get(name.rpartition('.')[-1])
+
+        def _get_key(name, afile, bfile):
+            # identifies the handler and the content of both sides, and the
+            # compressed size the results are scaled to.
+            return (_get_handler(name),) + tuple(
+                    (info.CRC, info.file_size,
+                     (info.compress_size, info.compress_type)
+                     if self._estimator else None)
+                    if info and info.file_size else None
+                    for info in (afile, bfile))
+
+        def _entries():
+            afiles = {info.filename: info for info in a.infolist()} if a else {}
+
+            if b:
+                for bfile in b.infolist():
+                    afile = afiles.pop(bfile.filename, None)
+                    if (afile and afile.CRC == bfile.CRC and
+                            afile.file_size == bfile.file_size and
+                            (not self._estimator or
+                             afile.compress_size == bfile.compress_size)):
+                        # identical content has no size changes, unless it
+                        # is compressed differently.
+                        continue
 
-        afiles = {info.filename: info for info in a.infolist()} if a else {}
+                    # File added or updated.
+                    yield (bfile.filename, afile, bfile)
+
+            for afile in afiles.values():
+                # file deleted.
+                yield (afile.filename, afile, None)
+
+        def _load(zipf, name):
+            # runs on a worker thread; zlib inflates without holding the GIL.
+            return BytesIO(_read_entry(zipf, name, lock))
+
+        def _prefetch(entries, executor):
+            # Read and inflate upcoming entries on worker threads while the
+            # current one is parsed. Entries are yielded in order, and no new
+            # entries are loaded while more than PREFETCH_SIZE bytes are
+            # waiting to be parsed. Chunks of szip libraries are not
+            # prefetched: they are inflated from the loaded entry, so no I/O
+            # is left to overlap, and most of their cost is the BCJ unfilter,
+            # which holds the GIL.
+            pending = deque()
+            pending_size = 0
+
+            def _ready():
+                name, afile, bfile, loads, size = pending[0]
+                return (pending_size > PREFETCH_SIZE or
+                        all(load.done() for load in loads if load))
+
+            def _pop():
+                name, afile, bfile, loads, size = pending.popleft()
+                aload, bload = loads
+                return (name, afile, bfile,
+                        aload.result() if aload else None,
+                        bload.result() if bload else None,
+                        size)
+
+            for name, afile, bfile in entries:
+                loads = (None, None)
+                size = 0
+                if (_get_handler(name) and (memo is None or
+                        _get_key(name, afile, bfile) not in memo)):
+                    loads = tuple(
+                            executor.submit(_load, zipf, name)
+                            if info and info.file_size else None
+                            for zipf, info in ((a, afile), (b, bfile)))
+                    size = sum(info.file_size
+                               for info in (afile, bfile) if info)
+                pending.append((name, afile, bfile, loads, size))
+                pending_size += size
+
+                while pending and _ready():
+                    item = _pop()
+                    pending_size -= item[-1]
+                    yield item[:-1]
+
+            while pending:
+                yield _pop()[:-1]
+
+        def _lazy(entries):
+            for name, afile, bfile in entries:
+                yield (name, afile, bfile,
+                       a.open(name) if afile and afile.file_size else None,
+                       b.open(name) if bfile and bfile.file_size else None)
+
+        def _diff_files(files):
+            for name, afile, bfile, af, bf in files:
+                handler = _get_handler(name)
+                if handler:
+                    if memo is None:
+                        diffs = self._run_handler(handler, prefix + name,
+                                                  af, bf, afile, bfile)
+                    else:
+                        diffs = self._run_memoized(
+                                memo, _get_key(name, afile, bfile),
+                                handler, prefix + name, af, bf, afile, bfile)
+                    for diff in diffs:
+                        yield diff
+                    continue
 
-        if b:
-            for bfile in b.infolist():
-                name = bfile.filename
-                afile = afiles.pop(name, None)
+                asize, bsize = (
+                        (info.compress_size if self._estimator
+                         else info.file_size) if info else 0
+                        for info in (afile, bfile))
+                if asize != bsize:
+                    yield Diff(prefix + name, asize, bsize)
 
-                # File added or updated.
-                for diff in _diff_file(name,
-                                       afile.file_size if afile else 0,
-                                       bfile.file_size):
-                    yield diff
+        if self._depth < DEPTH_SOURCE:
+            # shallow handlers only read parts of entries, so open them lazily.
+            for diff in _diff_files(_lazy(_entries())):
+                yield diff
+            return
 
-        for afile in afiles.values():
-            # file deleted.
-            for diff in _diff_file(afile.filename, afile.file_size, 0):
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            for diff in _diff_files(_prefetch(_entries(), executor)):
                 yield diff
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
 if __name__ == '__main__':
-    import sys
-
-    differ = Differ()
-    for diff in differ.diff_zip(sys.argv[1], sys.argv[2]):
-        print(diff)
+    from compress import RatioEstimator
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--depth', choices=DEPTHS,
+                        default=DEPTHS[DEPTH_SOURCE],
+                        help='how deep to analyse entries (default: source)')
+    parser.add_argument('-c', '--compressed', action='store_true',
+                        help='report compressed sizes instead of '
+                             'uncompressed sizes')
+    parser.add_argument('-e', '--export', metavar='SNAPSHOT',
+                        help='write a size snapshot of before-apk to SNAPSHOT '
+                             'instead of diffing')
+    parser.add_argument('a', metavar='before-apk')
+    parser.add_argument('b', metavar='after-apk', nargs='?')
+    args = parser.parse_args()
+
+    differ = Differ(depth=DEPTHS.index(args.depth),
+                    estimator=RatioEstimator() if args.compressed else None)
+    if args.export:
+        with open(args.export, 'wb') as out:
+            differ.export(args.a, out)
+    elif not args.b:
+        parser.error('after-apk is required unless exporting a snapshot')
+    else:
+        for diff in differ.diff_zip(args.a, args.b):
+            print(diff)
 
@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
-from diff import Diff, Differ
+from compress import RatioEstimator
+from diff import DEPTH_SOURCE, DEPTHS, Diff, Differ
 from io import BytesIO
 from szip import SZipFile
 from zipfile import ZipFile
 
 import struct
 
-def get_so_handler(asym, bsym):
+def get_so_handler(asym, bsym, depth=DEPTH_SOURCE, estimator=None):
 
     def _find_sym(symzip, name):
         basename = name.rpartition('/')[-1] + '/'
@@ -45,7 +46,7 @@ def get_so_handler(asym, bsym):
 
         return total
 
-    def _add_elf_sizes(elf, sizes, text_size):
+    def _add_elf_sizes(elf, sizes, text_size, srcnames):
         fmt = '<LBB 26x L 10x HHH'
         (magic, bits, endian, shoff, shent, shnum, shstr
                 ) = struct.unpack(fmt, elf.read(struct.calcsize(fmt)))
@@ -58,11 +59,11 @@ def get_so_handler(asym, bsym):
 
         elf.seek(shoff)
         for i in range(shnum):
-            fmt = '<L 12x LL'
+            fmt = '<LL 8x LL'
             fmt += str(shent - struct.calcsize(fmt)) + 'x'
-            (shnameidx, shoff, shsize) = struct.unpack(
+            (shnameidx, shtype, shoff, shsize) = struct.unpack(
                     fmt, elf.read(struct.calcsize(fmt)))
-            sections[shnameidx] = shsize
+            sections[shnameidx] = (shtype, shoff, shsize)
 
             if i == shstr:
                 # extract string names
@@ -72,16 +73,35 @@ def get_so_handler(asym, bsym):
         elf.seek(shstroff)
         shstr = elf.read(shstrsize)
 
-        for shnameidx, shsize in sections.items():
+        for shnameidx, (shtype, shoff, shsize) in sections.items():
             shnameend = shnameidx
             while shstr[shnameend]:
                 shnameend += 1
 
             shname = bytes(shstr[shnameidx: shnameend])
+            ratio = 1
+
+            if estimator:
+                # SHT_NOBITS sections take no space in the file.
+                ratio = 0
+                if shtype != 8:
+                    elf.seek(shoff)
+                    data = elf.read(shsize)
+                    if elf.compressed:
+                        # szip compresses the ELF even if its apk entry is
+                        # stored.
+                        with estimator.stored(False):
+                            ratio = estimator.ratio(data, shname)
+                    else:
+                        ratio = estimator.ratio(data, shname)
+
             if shname == b'.text':
                 shsize -= text_size
+                # source file sizes are all part of .text.
+                for srcname in srcnames:
+                    sizes[srcname] *= ratio
 
-            sizes[shname] = shsize
+            sizes[shname] = shsize * ratio
 
     def _so_handler(name, a, b):
         asymsizes = dict()
@@ -89,25 +109,27 @@ def get_so_handler(asym, bsym):
 
         if a:
             asymtotal = 0
-            with ZipFile(asym) as asymzip:
-                symname = _find_sym(asymzip, name)
-                if symname:
-                    with asymzip.open(symname) as sym:
-                        asymtotal = _add_sym_sizes(sym, asymsizes)
+            if depth >= DEPTH_SOURCE:
+                with ZipFile(asym) as asymzip:
+                    symname = _find_sym(asymzip, name)
+                    if symname:
+                        with asymzip.open(symname) as sym:
+                            asymtotal = _add_sym_sizes(sym, asymsizes)
 
             with SZipFile(a) as aelf:
-                _add_elf_sizes(aelf, asymsizes, asymtotal)
+                _add_elf_sizes(aelf, asymsizes, asymtotal, list(asymsizes))
 
         if b:
             bsymtotal = 0
-            with ZipFile(bsym) as bsymzip:
-                symname = _find_sym(bsymzip, name)
-                if symname:
-                    with bsymzip.open(symname) as sym:
-                        bsymtotal = _add_sym_sizes(sym, bsymsizes)
+            if depth >= DEPTH_SOURCE:
+                with ZipFile(bsym) as bsymzip:
+                    symname = _find_sym(bsymzip, name)
+                    if symname:
+                        with bsymzip.open(symname) as sym:
+                            bsymtotal = _add_sym_sizes(sym, bsymsizes)
 
             with SZipFile(b) as belf:
-                _add_elf_sizes(belf, bsymsizes, bsymtotal)
+                _add_elf_sizes(belf, bsymsizes, bsymtotal, list(bsymsizes))
 
         for srcname, bsize in bsymsizes.items():
             asize = asymsizes.pop(srcname, 0)
@@ -121,15 +143,38 @@ def get_so_handler(asym, bsym):
     return _so_handler
 
 if __name__ == '__main__':
-    import sys
-
-    a, b = sys.argv[1:3]
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--depth', choices=DEPTHS,
+                        default=DEPTHS[DEPTH_SOURCE],
+                        help='how deep to analyse entries (default: source)')
+    parser.add_argument('-c', '--compressed', action='store_true',
+                        help='report compressed sizes instead of '
+                             'uncompressed sizes')
+    parser.add_argument('-e', '--export', metavar='SNAPSHOT',
+                        help='write a size snapshot of before-apk to SNAPSHOT '
+                             'instead of diffing')
+    parser.add_argument('a', metavar='before-apk')
+    parser.add_argument('b', metavar='after-apk', nargs='?')
+    args = parser.parse_args()
+
+    if not args.export and not args.b:
+        parser.error('after-apk is required unless exporting a snapshot')
+
+    a, b = args.a, args.b or ''
     asym, bsym = (s.replace('.multi.', '.en-US.')
                    .replace('.apk', '.crashreporter-symbols.zip') for s in (a, b))
 
-    differ = Differ()
-    differ.set_handler('so', get_so_handler(asym, bsym))
-
-    for diff in differ.diff_zip(a, b):
-        print(diff)
+    depth = DEPTHS.index(args.depth)
+    estimator = RatioEstimator() if args.compressed else None
+    differ = Differ(depth=depth, estimator=estimator)
+    differ.set_handler('so', get_so_handler(asym, bsym, depth, estimator))
+
+    if args.export:
+        with open(args.export, 'wb') as out:
+            differ.export(a, out)
+    else:
+        for diff in differ.diff_zip(a, b):
+            print(diff)
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+from array import array
+
+import io
+import mmap
+import os
+import struct
+import sys
+
+# Snapshot layout, all fields little-endian:
+#
+#   header    '<8s L L L L' magic, version, string count, node count and
+#             string data size
+#   strings   (string count + 1) u32 offsets into the string data, followed
+#             by the utf-8 string data padded to 8 bytes
+#   nodes     node count u32 parent indices, then node count u32 string ids
+#   sizes     node count i64 sizes, which can be negative, e.g. for .text
+#             after source file sizes are taken out
+#
+# Each node is one path component, e.g. 'lib', 'libxul.so' and '.text' for
+# 'lib/libxul.so/.text', and components are interned in the string table.
+# Nodes are stored in pre-order with children sorted by name, so walking the
+# nodes yields paths sorted by path_key().
+
+MAGIC = b'APKSNAP\0'
+VERSION = 1
+NO_PARENT = 0xffffffff
+
+_header_fmt = '<8s L L L L'
+_header_size = struct.calcsize(_header_fmt)
+
+def path_key(name):
+    return name.split('/')
+
+def is_snapshot(f):
+    if isinstance(f, str):
+        if not os.path.isfile(f):
+            return False
+        with open(f, 'rb') as snapshot:
+            return snapshot.read(len(MAGIC)) == MAGIC
+
+    # snapshots are read through mmap, so they need a real file.
+    try:
+        f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+def _pad(size):
+    return (size + 7) & ~7
+
+def write_snapshot(f, sizes):
+    # node is [size, {name: child node}]
+    root = [0, dict()]
+    for name, size in sizes:
+        node = root
+        for part in path_key(name):
+            node = node[1].setdefault(part, [0, dict()])
+        node[0] += size
+
+    strings = []
+    string_ids = dict()
+    parents = array('I')
+    names = array('I')
+    node_sizes = array('q')
+
+    def _intern(s):
+        string_id = string_ids.get(s)
+        if string_id is None:
+            string_id = string_ids[s] = len(strings)
+            strings.append(s.encode('utf-8'))
+        return string_id
+
+    def _push_children(stack, parent, node):
+        # push in reverse so children are visited in sorted order.
+        for part, child in sorted(node[1].items(), reverse=True):
+            stack.append((parent, part, child))
+
+    stack = []
+    _push_children(stack, NO_PARENT, root)
+    while stack:
+        parent, part, node = stack.pop()
+        _push_children(stack, len(parents), node)
+        parents.append(parent)
+        names.append(_intern(part))
+        node_sizes.append(node[0])
+
+    string_offs = array('I', [0])
+    for s in strings:
+        string_offs.append(string_offs[-1] + len(s))
+    string_data = b''.join(strings)
+
+    if sys.byteorder != 'little':
+        for column in (string_offs, parents, names, node_sizes):
+            column.byteswap()
+
+    header = struct.pack(_header_fmt, MAGIC, VERSION, len(strings),
+                         len(parents), len(string_data))
+    off = len(header) + len(string_offs) * 4 + len(string_data)
+    f.write(header)
+    f.write(string_offs.tobytes())
+    f.write(string_data)
+    f.write(b'\0' * (_pad(off) - off))
+
+    off = len(parents) * 8
+    f.write(parents.tobytes())
+    f.write(names.tobytes())
+    f.write(b'\0' * (_pad(off) - off))
+    f.write(node_sizes.tobytes())
+
+class Snapshot(object):
+    def __init__(self, f):
+        if isinstance(f, str):
+            f = open(f, 'rb')
+        self._file = f
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = [memoryview(self._map)]
+
+        (magic, version, string_count, node_count, string_data_size
+                ) = struct.unpack_from(_header_fmt, self._map)
+
+        assert magic == MAGIC
+        assert version == VERSION
+
+        off = _header_size
+        self._string_offs = self._column(off, 'I', string_count + 1)
+        off += (string_count + 1) * 4
+        self._string_data = self._view(off, string_data_size)
+        off = _pad(off + string_data_size)
+        self._parents = self._column(off, 'I', node_count)
+        off += node_count * 4
+        self._names = self._column(off, 'I', node_count)
+        off = _pad(off + node_count * 4)
+        self._sizes = self._column(off, 'q', node_count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        # views into the map have to be released before closing it.
+        for view in reversed(self._views):
+            view.release()
+        self._map.close()
+        self._file.close()
+
+    def _view(self, off, size):
+        view = self._views[0][off: off + size]
+        self._views.append(view)
+        return view
+
+    def _column(self, off, fmt, count):
+        view = self._view(off, count * struct.calcsize(fmt))
+        if sys.byteorder == 'little':
+            column = view.cast(fmt)
+            self._views.append(column)
+            return column
+
+        column = array(fmt, view.tobytes())
+        column.byteswap()
+        return column
+
+    def _get_str(self, string_id):
+        return bytes(self._string_data[self._string_offs[string_id]:
+                                       self._string_offs[string_id + 1]]
+                     ).decode('utf-8')
+
+    def items(self):
+        # (name, size) pairs sorted by path_key().
+        paths = []
+        parents = self._parents
+        names = self._names
+        sizes = self._sizes
+
+        for node in range(len(parents)):
+            parent = parents[node]
+            while paths and paths[-1][0] != parent:
+                paths.pop()
+
+            name = self._get_str(names[node])
+            if paths:
+                name = paths[-1][1] + '/' + name
+            paths.append((node, name))
+
+            if sizes[node]:
+                yield (name, sizes[node])
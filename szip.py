@@ -6,12 +6,12 @@ from ctypes.util import find_library
 import io
 import struct
 
-def _bcj_filter_thumb(buf, offset, chunkSize, unfilter):
+def _bcj_filter_thumb(buf, offset, size, chunkSize, unfilter):
     end = offset
 
-    while end < len(buf):
+    while end < offset + size:
         i = end
-        end = min(len(buf), end + chunkSize)
+        end = min(offset + size, end + chunkSize)
 
         while (i + 4) <= end:
             if (buf[i + 1] & 0xf8) != 0xf0 or (buf[i + 3] & 0xf8) != 0xf8:
@@ -36,12 +36,12 @@ def _bcj_filter_thumb(buf, offset, chunkSize, unfilter):
 
     return buf
 
-def _bcj_filter_arm(buf, offset, chunkSize, unfilter):
+def _bcj_filter_arm(buf, offset, size, chunkSize, unfilter):
     end = offset
 
-    while end < len(buf):
+    while end < offset + size:
         i = end
-        end = min(len(buf), end + chunkSize)
+        end = min(offset + size, end + chunkSize)
 
         while (i + 4) <= end:
             if buf[i + 3] != 0xeb:
@@ -105,7 +105,11 @@ class SZipFile(object):
         self._passthru = False
 
         fmt = '<L'
-        magic = f.peek(struct.calcsize(fmt))
+        if f.seekable():
+            magic = f.read(struct.calcsize(fmt))
+            f.seek(-len(magic), io.SEEK_CUR)
+        else:
+            magic = f.peek(struct.calcsize(fmt))
         (magic,) = struct.unpack(fmt, magic[0: struct.calcsize(fmt)])
 
         if magic == 0x464c457f:
@@ -129,7 +133,10 @@ class SZipFile(object):
         self._offsets = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
 
         self._outSize = (self._nChunks - 1) * self._chunkSize + self._lastChunkSize
-        self._buffer = bytearray()
+        # chunks are decompressed on demand, so seeking only costs the chunks
+        # that are actually read.
+        self._buffer = bytearray(self._outSize)
+        self._loaded = bytearray(self._nChunks)
         self._index = 0
 
     def __enter__(self):
@@ -142,45 +149,46 @@ class SZipFile(object):
     def close(self):
         self._file.close()
 
-    def _ensure(self, size):
-        if len(self._buffer) >= size:
-            return
+    @property
+    def compressed(self):
+        # False for regular ELF files, which are read as is.
+        return not self._passthru
 
+    def _ensure(self, start, end):
         chunkSize = self._chunkSize
-        oldSize = len(self._buffer)
-        oldChunk = (oldSize + chunkSize - 1) // chunkSize
-        newChunk = (size + chunkSize - 1) // chunkSize
-        newSize = min(self._outSize, newChunk * chunkSize)
-
-        self._buffer.extend(bytearray(newSize - oldSize))
+        zstream = None
 
-        zstream = ZStream()
-        zstream.zalloc = None
-        zstream.zfree = None
-        zstream.opaque = None
+        for i in range(start // chunkSize, (end + chunkSize - 1) // chunkSize):
+            if self._loaded[i]:
+                continue
 
-        for i in range(oldChunk, newChunk):
+            self._file.seek(self._offsets[i])
             if i < self._nChunks - 1:
                 data = self._file.read(self._offsets[i + 1] - self._offsets[i])
             else:
                 data = self._file.read()
 
-            zstream.next_in = (c_byte * len(data)).from_buffer_copy(data)
-            zstream.avail_in = len(data)
-
-            start = i * chunkSize
-            zstream.next_out = (c_byte * min(chunkSize, newSize - start)
-                    ).from_buffer(self._buffer, start)
-            zstream.avail_out = chunkSize
-
-            if i != oldChunk:
+            if zstream:
                 if libz.inflateReset(byref(zstream)) != Z_OK:
                     raise Exception('zlib: ' + zstream.msg.decode('utf-8'))
             else:
+                zstream = ZStream()
+                zstream.zalloc = None
+                zstream.zfree = None
+                zstream.opaque = None
                 if libz.inflateInit2_(byref(zstream), self._windowBits,
                                       b"1.2.8", sizeof(zstream)) != Z_OK:
                     raise Exception('zlib: initialization failed')
 
+            zstream.next_in = (c_byte * len(data)).from_buffer_copy(data)
+            zstream.avail_in = len(data)
+
+            chunkStart = i * chunkSize
+            chunkLen = min(chunkSize, self._outSize - chunkStart)
+            zstream.next_out = (c_byte * chunkLen).from_buffer(
+                    self._buffer, chunkStart)
+            zstream.avail_out = chunkLen
+
             if self._dictionary:
                 if libz.inflateSetDictionary(byref(zstream), self._dictionary,
                                              len(self._dictionary)) != Z_OK:
@@ -189,15 +197,19 @@ class SZipFile(object):
             if libz.inflate(byref(zstream), Z_FINISH) != Z_STREAM_END:
                 raise Exception('zlib: ' + zstream.msg.decode('utf-8'))
 
-        if libz.inflateEnd(byref(zstream)) != Z_OK:
-            raise Exception('zlib: ' + zstream.msg.decode('utf-8'))
+            if self._filt == 1:
+                _bcj_filter_thumb(self._buffer, chunkStart, chunkLen,
+                                  chunkSize, unfilter=True)
+            elif self._filt == 2:
+                _bcj_filter_arm(self._buffer, chunkStart, chunkLen,
+                                chunkSize, unfilter=True)
+            else:
+                assert self._filt == 0
 
-        if self._filt == 1:
-            _bcj_filter_thumb(self._buffer, oldSize, chunkSize, unfilter=True)
-        elif self._filt == 2:
-            _bcj_filter_arm(self._buffer, oldSize, chunkSize, unfilter=True)
-        else:
-            assert self._filt == 0
+            self._loaded[i] = 1
+
+        if zstream and libz.inflateEnd(byref(zstream)) != Z_OK:
+            raise Exception('zlib: ' + zstream.msg.decode('utf-8'))
 
     def read(self, size=-1):
         if self._passthru:
@@ -207,7 +219,7 @@ class SZipFile(object):
             raise EOFError()
 
         end = min(self._outSize, self._outSize if size < 0 else self._index + size)
-        self._ensure(end)
+        self._ensure(self._index, end)
 
         out = self._buffer[self._index: end]
         self._index += len(out)